@@ -11,40 +11,67 @@ try:
     import socket
     import struct
     import subprocess
-    import shutil
-    import glob
     import cairo
     import tempfile
+    import traceback
+    import concurrent.futures
 except Exception as e:
     print("Missing dependencies: %s" % str(e))
     sys.exit(77)
 
 FPrint = None
 
+# All messages to the driver start with a pair of native ints
+pack_header = struct.Struct('ii').pack
+
 # Exit with error on any exception, included those happening in async callbacks
 sys.excepthook = lambda *args: (traceback.print_exception(*args), sys.exit(1))
 
 def load_image(img):
     png = cairo.ImageSurface.create_from_png(img)
 
-    # Cairo wants 4 byte aligned rows, so just add a few pixel if necessary
-    w = png.get_width()
-    h = png.get_height()
-    w = (w + 3) // 4 * 4
-    h = (h + 3) // 4 * 4
-    img = cairo.ImageSurface(cairo.Format.A8, w, h)
-    cr = cairo.Context(img)
-
-    cr.set_source_rgba(1, 1, 1, 1)
-    cr.paint()
+    # The driver expects tightly packed rows, so pad the image to the row
+    # stride cairo uses for A8 to be able to send the data as is.
+    stride = cairo.ImageSurface.format_stride_for_width(cairo.Format.A8,
+                                                        png.get_width())
+    h = (png.get_height() + 3) // 4 * 4
+
+    # The prints are grey+alpha PNGs, which cairo loads as ARGB32. Only that
+    # format is handled: the alpha channel is the image, copy it over
+    # directly rather than having cairo composite it. Padding stays
+    # transparent, as it did with the OPERATOR_SOURCE paint used before.
+    if png.get_format() != cairo.Format.ARGB32:
+        raise ValueError('Print {} needs an alpha channel'.format(img))
+
+    buf = bytearray(stride * h)
+
+    png.flush()
+    png_w = png.get_width()
+    png_stride = png.get_stride()
+    # ARGB32 pixels are native endian words with alpha in the top byte, so
+    # pick every fourth byte of the whole image in one go.
+    alpha = 3 if sys.byteorder == 'little' else 0
+    data = png.get_data()[alpha::4].tobytes()
+    if png_stride == png_w * 4 and png_w == stride:
+        buf[:len(data)] = data
+    else:
+        # Rows need padding (whorl.png is 250 pixels wide), so after the
+        # strided slice above they still get copied over one by one
+        src_stride = png_stride // 4
+        for y in range(png.get_height()):
+            src = y * src_stride
+            buf[y * stride:y * stride + png_w] = data[src:src + png_w]
 
-    cr.set_source_rgba(0, 0, 0, 0)
-    cr.set_operator(cairo.OPERATOR_SOURCE)
+    return cairo.ImageSurface.create_for_data(buf, cairo.Format.A8, stride, h,
+                                              stride)
 
-    cr.set_source_surface(png)
-    cr.paint()
+def encode_image(img):
+    # The surface data is sent as is, without copying it out of cairo
+    img.flush()
+    assert img.get_stride() == img.get_width()
+    mem = img.get_data()
 
-    return img
+    return [pack_header(img.get_width(), img.get_height()), mem]
 
 if 'FP_PRINTS_PATH' in os.environ:
     prints_path = os.environ['FP_PRINTS_PATH']
@@ -58,11 +85,18 @@ else:
 
 ctx = GLib.main_context_default()
 
+# Enroll date of all prints, the same for the whole run
+today = GLib.Date()
+today.set_dmy(*GLib.DateTime.new_now_local().get_ymd()[::-1])
+
 class VirtualImage(unittest.TestCase):
 
     @classmethod
     def setUpClass(cls):
-        cls.tmpdir = tempfile.mkdtemp(prefix='libfprint-')
+        # Keep the socket path short, it needs to fit into sun_path
+        cls._tmpdir = tempfile.TemporaryDirectory(prefix='fpi-')
+        cls.addClassCleanup(cls._tmpdir.cleanup)
+        cls.tmpdir = cls._tmpdir.name
 
         cls.sockaddr = os.path.join(cls.tmpdir, 'virtual-image.socket')
         os.environ['FP_VIRTUAL_IMAGE'] = cls.sockaddr
@@ -78,83 +112,172 @@ class VirtualImage(unittest.TestCase):
 
         assert cls.dev is not None, "You need to compile with virtual_image for testing"
 
+        with os.scandir(prints_path) as it:
+            files = [e.path for e in it if e.name.endswith('.png')]
+        # PNG decoding happens in cairo, so load all prints in parallel
+        with concurrent.futures.ThreadPoolExecutor() as executor:
+            images = executor.map(load_image, files)
+
         cls.prints = {}
-        for f in glob.glob(os.path.join(prints_path, '*.png')):
+        for f, img in zip(files, images):
             n = os.path.basename(f)[:-4]
-            cls.prints[n] = load_image(f)
+            # Keep the encoded buffers around, prints are sent many times
+            cls.prints[n] = (img, encode_image(img))
 
         assert cls.prints, "No prints found in " + prints_path
+        cls.max_payload = max(sum(len(b) for b in p[1])
+                              for p in cls.prints.values())
 
     @classmethod
     def tearDownClass(cls):
-        shutil.rmtree(cls.tmpdir)
         del cls.dev
         del cls.ctx
 
     def setUp(self):
+        self._loop = GLib.MainLoop(ctx)
         self.dev.open_sync()
 
-        self.con = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        # The driver reads from the same main loop, so never block on it
+        self.con = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM |
+                                 socket.SOCK_NONBLOCK | socket.SOCK_CLOEXEC)
         self.con.connect(self.sockaddr)
+        # Make sure any print fits into the socket buffer in one go, the
+        # default is usually large enough already and must not be shrunk
+        sndbuf = self.max_payload + 4096
+        if self.con.getsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF) < sndbuf:
+            self.con.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, sndbuf)
+        self._pending = bytearray()
+        self._outgoing = []
+        self._write_source = 0
 
     def tearDown(self):
+        if self._write_source:
+            GLib.source_remove(self._write_source)
         self.con.close()
         del self.con
         self.dev.close_sync()
 
-    def send_retry(self, retry_error=None, iterate=True):
+    def send_command(self, command, value, iterate=False):
+        # Control messages are only queued here. The queue is flushed by
+        # run_loop_until() (and so iterate_pending() and every wait) or
+        # together with the next send_image(). Only send_finger_report()
+        # iterates by default, as the finger status is checked right after.
+        self._pending += pack_header(command, value)
+        if iterate:
+            self.iterate_pending()
+
+    def flush_commands(self):
+        if self._pending:
+            pending, self._pending = self._pending, bytearray()
+            self.send_buffers([pending])
+
+    def write_outgoing(self):
+        # Write as much as the socket takes, returns whether data is left
+        while self._outgoing:
+            try:
+                sent = self.con.sendmsg(self._outgoing)
+            except BlockingIOError:
+                break
+
+            while sent:
+                if sent < len(self._outgoing[0]):
+                    self._outgoing[0] = self._outgoing[0][sent:]
+                    break
+                sent -= len(self._outgoing.pop(0))
+
+        return bool(self._outgoing)
+
+    def on_writable(self, fd, condition):
+        if self.write_outgoing():
+            return GLib.SOURCE_CONTINUE
+
+        self._write_source = 0
+        self._loop.quit()
+        return GLib.SOURCE_REMOVE
+
+    def send_buffers(self, buffers):
+        # Pass all buffers to the kernel at once rather than joining them.
+        # Whatever does not fit is written once the driver has read enough.
+        self._outgoing += [memoryview(b).cast('B') for b in buffers if len(b)]
+        if self.write_outgoing():
+            if not self._write_source:
+                self._write_source = GLib.io_add_watch(self.con.fileno(),
+                    GLib.PRIORITY_DEFAULT, GLib.IOCondition.OUT, self.on_writable)
+        elif self._write_source:
+            # A nested send flushed data an outer send is still waiting for
+            GLib.source_remove(self._write_source)
+            self._write_source = 0
+            self._loop.quit()
+
+        self.run_loop_until(lambda: not self._outgoing)
+
+    def send_retry(self, retry_error=None, iterate=False):
         retry_error = retry_error if retry_error else FPrint.DeviceRetry.TOO_SHORT
-        self.con.sendall(struct.pack('ii', -1, retry_error))
-        while iterate and ctx.pending():
-            ctx.iteration(False)
+        self.send_command(-1, retry_error, iterate)
 
-    def send_error(self, device_error=None, iterate=True):
+    def send_error(self, device_error=None, iterate=False):
         device_error = device_error if device_error else FPrint.DeviceError.GENERAL
-        self.con.sendall(struct.pack('ii', -2, device_error))
-        while iterate and ctx.pending():
-            ctx.iteration(False)
+        self.send_command(-2, device_error, iterate)
 
-    def send_finger_automatic(self, automatic, iterate=True):
+    def send_finger_automatic(self, automatic, iterate=False):
         # Set whether finger on/off is reported around images
-        self.con.sendall(struct.pack('ii', -3, 1 if automatic else 0))
-        while iterate and ctx.pending():
-            ctx.iteration(False)
+        self.send_command(-3, 1 if automatic else 0, iterate)
 
     def send_finger_report(self, has_finger, iterate=True):
         # Send finger on/off
-        self.con.sendall(struct.pack('ii', -4, 1 if has_finger else 0))
-        while iterate and ctx.pending():
-            ctx.iteration(False)
-
-    def send_image(self, image, iterate=True):
-        img = self.prints[image]
-
-        mem = img.get_data()
-        mem = mem.tobytes()
-        assert len(mem) == img.get_width() * img.get_height()
-
-        encoded_img = struct.pack('ii', img.get_width(), img.get_height())
-        encoded_img += mem
+        self.send_command(-4, 1 if has_finger else 0, iterate)
+
+    def send_image(self, image, iterate=False):
+        # Any queued control messages go out together with the image
+        pending, self._pending = self._pending, bytearray()
+        self.send_buffers([pending] + self.prints[image][1])
+        if iterate:
+            self.iterate_pending()
+
+    def run_loop_until(self, condition):
+        # Callbacks changing the state we wait for need to quit the loop
+        self.flush_commands()
+        while not condition():
+            self._loop.run()
+
+    def iterate_pending(self):
+        # Dispatch everything that is ready, the idle source runs last
+        done = False
+        def on_idle():
+            nonlocal done
+            done = True
+            self._loop.quit()
 
-        self.con.sendall(encoded_img)
-        while iterate and ctx.pending():
-            ctx.iteration(False)
+        GLib.idle_add(on_idle)
+        self.run_loop_until(lambda: done)
 
     def wait_for_finger_status(self, finger_status, timeout=5000):
         done = False
         def on_timeout_reached():
             nonlocal done
             done = True
+            self._loop.quit()
 
         if 'UNDER_VALGRIND' in os.environ:
             timeout = timeout * 3
 
+        # Only query the status again when it changed
+        status = self.dev.get_finger_status()
+        def on_finger_status_changed(dev, pspec):
+            nonlocal status
+            status = dev.get_finger_status()
+            self._loop.quit()
+
         source = GLib.timeout_add(timeout, on_timeout_reached)
-        while not done:
-            if self.dev.get_finger_status() & finger_status:
-                GLib.source_remove(source)
-                return
-            ctx.iteration(True)
+        handler = self.dev.connect('notify::finger-status',
+                                   on_finger_status_changed)
+        try:
+            self.run_loop_until(lambda: done or status & finger_status)
+        finally:
+            self.dev.disconnect(handler)
+
+        if not done:
+            GLib.source_remove(source)
 
         self.assertFalse(done)
 
@@ -183,6 +306,7 @@ class VirtualImage(unittest.TestCase):
             assert cm.exception.matches(Gio.io_error_quark(), Gio.IOErrorEnum.CANCELLED)
             print("Capture cancelled as expected")
             obj._cancelled = True
+            obj._loop.quit()
 
         self._cancelled = False
         self.dev.capture(True, cancel, cancelled_cb, self)
@@ -192,15 +316,59 @@ class VirtualImage(unittest.TestCase):
         assert cm.exception.matches(FPrint.device_error_quark(), FPrint.DeviceError.BUSY)
 
         cancel.cancel()
-        while not self._cancelled:
-            ctx.iteration(True)
+        self.run_loop_until(lambda: self._cancelled)
 
     def enroll_print(self, image, template=None):
         self._step = 0
         self._enrolled = None
 
+        # The steps run from GLib callbacks, where a failing assertion would
+        # end up in sys.excepthook. So only record the finger status there,
+        # and any error, and check both once the loop returned.
+        finger_status = []
+        step_error = None
+
+        def finger_removed_after_scan():
+            # Test the image-device path where the finger is removed after
+            # the minutiae scan is completed.
+            self.send_finger_automatic(False)
+            finger_status.append(self.dev.get_finger_status())
+            self.send_finger_report(True)
+            finger_status.append(self.dev.get_finger_status())
+            self.send_image(image)
+
+        def finger_removed():
+            self.send_finger_report(False)
+            finger_status.append(self.dev.get_finger_status())
+            self.send_finger_automatic(True)
+            self.send_image(image)
+
+        def next_image():
+            finger_status.append(self.dev.get_finger_status())
+            self.send_image(image)
+
+        # Note: Assumes 5 enroll steps for this device!
+        steps = [
+            finger_removed_after_scan,
+            finger_removed,
+            next_image,
+            next_image,
+        ]
+
+        def run_step(step):
+            nonlocal step_error
+            try:
+                step()
+            except Exception as e:
+                step_error = e
+                self._loop.quit()
+
         def progress_cb(dev, step, fp, user_data):
             print('Print was processed, continuing')
+            # Feed the next scan once the driver is done with this one
+            if self._step < step <= len(steps):
+                GLib.idle_add(run_step, steps[step - 1],
+                              priority=GLib.PRIORITY_HIGH)
             self._step = step
 
         def done_cb(dev, res):
@@ -208,55 +376,31 @@ class VirtualImage(unittest.TestCase):
             fp = dev.enroll_finish(res)
             self.assertEqual(self.dev.get_finger_status(), FPrint.FingerStatusFlags.NONE)
             self._enrolled = fp
+            self._loop.quit()
 
         if template is None:
             template = FPrint.Print.new(self.dev)
             template.props.finger = FPrint.Finger.LEFT_THUMB
             template.props.username = "testuser"
             template.props.description = "test print"
-            datetime = GLib.DateTime.new_now_local()
-            date = GLib.Date()
-            date.set_dmy(*datetime.get_ymd()[::-1])
-            template.props.enroll_date = date
+            template.props.enroll_date = today
         self.assertEqual(self.dev.get_finger_status(), FPrint.FingerStatusFlags.NONE)
         self.dev.enroll(template, None, progress_cb, tuple(), done_cb)
 
-        # Note: Assumes 5 enroll steps for this device!
         self.wait_for_finger_status(FPrint.FingerStatusFlags.NEEDED)
         self.send_image(image)
-        while self._step < 1:
-            ctx.iteration(True)
-
-        # Test the image-device path where the finger is removed after
-        # the minutiae scan is completed.
-        self.send_finger_automatic(False)
-        self.assertEqual(self.dev.get_finger_status(), FPrint.FingerStatusFlags.NEEDED)
-        self.send_finger_report(True)
-        self.assertEqual(self.dev.get_finger_status(),
-            FPrint.FingerStatusFlags.NEEDED | FPrint.FingerStatusFlags.PRESENT)
-        self.send_image(image)
-        while self._step < 2:
-            ctx.iteration(True)
-        self.send_finger_report(False)
-
-        self.assertEqual(self.dev.get_finger_status(), FPrint.FingerStatusFlags.NEEDED)
-
-        self.send_finger_automatic(True)
-        self.send_image(image)
-        while self._step < 3:
-            ctx.iteration(True)
-
-        self.assertEqual(self.dev.get_finger_status(), FPrint.FingerStatusFlags.NEEDED)
-
-        self.send_image(image)
-        while self._step < 4:
-            ctx.iteration(True)
-
-        self.assertEqual(self.dev.get_finger_status(), FPrint.FingerStatusFlags.NEEDED)
-
-        self.send_image(image)
-        while self._enrolled is None:
-            ctx.iteration(True)
+        self.run_loop_until(lambda: self._enrolled is not None or
+                            step_error is not None)
+
+        if step_error is not None:
+            raise step_error
+        self.assertEqual(finger_status, [
+            FPrint.FingerStatusFlags.NEEDED,
+            FPrint.FingerStatusFlags.NEEDED | FPrint.FingerStatusFlags.PRESENT,
+            FPrint.FingerStatusFlags.NEEDED,
+            FPrint.FingerStatusFlags.NEEDED,
+            FPrint.FingerStatusFlags.NEEDED,
+        ])
 
         self.assertEqual(self.dev.get_finger_status(), FPrint.FingerStatusFlags.NONE)
         self.assertEqual(self._enrolled.props.driver, self.dev.get_driver())
@@ -267,140 +411,95 @@ class VirtualImage(unittest.TestCase):
 
         return self._enrolled
 
-    def test_enroll_verify(self):
-        done = False
-
-        def verify_cb(dev, res):
+    def run_match(self, op, finish, enrolled, send, wait_for_finger=True):
+        # Run op (verify or identify) against the enrolled print(s) and feed
+        # it the image named by send, or call send() to feed it otherwise.
+        # Returns the result of finish() or the error it raised.
+        result = None
+        def match_cb(dev, res):
+            nonlocal result
+            print('Match finished')
             try:
-                self._verify_match, self._verify_fp = dev.verify_finish(res)
-            except gi.repository.GLib.Error as e:
-                self._verify_error = e
+                result = finish(res)
+            except GLib.Error as e:
+                print(e)
+                result = e
+            self._loop.quit()
 
+        op(enrolled, callback=match_cb)
+        if wait_for_finger:
+            self.wait_for_finger_status(FPrint.FingerStatusFlags.NEEDED)
+        if isinstance(send, str):
+            self.send_image(send)
+        else:
+            send()
+        self.run_loop_until(lambda: result is not None)
+
+        return result
+
+    def test_enroll_verify(self):
         fp_whorl = self.enroll_print('whorl')
 
-        self._verify_match = None
-        self._verify_fp = None
-        self.dev.verify(fp_whorl, callback=verify_cb)
-        self.wait_for_finger_status(FPrint.FingerStatusFlags.NEEDED)
-        self.send_image('whorl')
-        while self._verify_match is None:
-            ctx.iteration(True)
-        assert(self._verify_match)
-        self.assertIsNotNone(self._verify_fp.props.image)
-
-        self._verify_match = None
-        self._verify_fp = None
-        self.dev.verify(fp_whorl, callback=verify_cb)
-        self.wait_for_finger_status(FPrint.FingerStatusFlags.NEEDED)
-        self.send_image('tented_arch')
-        while self._verify_match is None:
-            ctx.iteration(True)
-        assert(not self._verify_match)
+        match, fp = self.run_match(self.dev.verify, self.dev.verify_finish,
+                                   fp_whorl, 'whorl')
+        assert(match)
+        self.assertIsNotNone(fp.props.image)
+
+        match, fp = self.run_match(self.dev.verify, self.dev.verify_finish,
+                                   fp_whorl, 'tented_arch')
+        assert(not match)
 
         # Test fingerprint updates
         # Enroll a second print
         fp_whorl_tended_arch = self.enroll_print('tented_arch', fp_whorl)
 
         # Make sure the first print verifies successfully after the update
-        self._verify_match = None
-        self._verify_fp = None
-        self.dev.verify(fp_whorl_tended_arch, callback=verify_cb)
-        self.wait_for_finger_status(FPrint.FingerStatusFlags.NEEDED)
-        self.send_image('whorl')
-        while self._verify_match is None:
-            ctx.iteration(True)
-        assert(self._verify_match)
+        match, fp = self.run_match(self.dev.verify, self.dev.verify_finish,
+                                   fp_whorl_tended_arch, 'whorl')
+        assert(match)
 
         # Make sure the second print verifies successfully after the update
-        self._verify_match = None
-        self._verify_fp = None
-        self.dev.verify(fp_whorl_tended_arch, callback=verify_cb)
-        self.wait_for_finger_status(FPrint.FingerStatusFlags.NEEDED)
-        self.send_image('tented_arch')
-        while self._verify_match is None:
-            ctx.iteration(True)
-        assert(self._verify_match)
+        match, fp = self.run_match(self.dev.verify, self.dev.verify_finish,
+                                   fp_whorl_tended_arch, 'tented_arch')
+        assert(match)
 
         # Test verify error cases
-        self._verify_fp = None
-        self._verify_error = None
-        self.dev.verify(fp_whorl, callback=verify_cb)
-        self.wait_for_finger_status(FPrint.FingerStatusFlags.NEEDED)
-        self.send_retry()
-        while self._verify_fp is None and self._verify_error is None:
-            ctx.iteration(True)
-        assert(self._verify_error is not None)
-        assert(self._verify_error.matches(FPrint.device_retry_quark(), FPrint.DeviceRetry.TOO_SHORT))
-
-        self._verify_fp = None
-        self._verify_error = None
-        self.dev.verify(fp_whorl, callback=verify_cb)
-        self.wait_for_finger_status(FPrint.FingerStatusFlags.NEEDED)
-        self.send_error()
-        while self._verify_fp is None and self._verify_error is None:
-            ctx.iteration(True)
-        assert(self._verify_error is not None)
-        print(self._verify_error)
-        assert(self._verify_error.matches(FPrint.device_error_quark(), FPrint.DeviceError.GENERAL))
+        error = self.run_match(self.dev.verify, self.dev.verify_finish,
+                               fp_whorl, self.send_retry)
+        self.assertIsInstance(error, GLib.Error)
+        assert(error.matches(FPrint.device_retry_quark(), FPrint.DeviceRetry.TOO_SHORT))
 
-    def test_identify(self):
-        done = False
+        error = self.run_match(self.dev.verify, self.dev.verify_finish,
+                               fp_whorl, self.send_error)
+        self.assertIsInstance(error, GLib.Error)
+        assert(error.matches(FPrint.device_error_quark(), FPrint.DeviceError.GENERAL))
 
+    def test_identify(self):
         fp_whorl = self.enroll_print('whorl')
         fp_tented_arch = self.enroll_print('tented_arch')
+        templates = [fp_whorl, fp_tented_arch]
 
-        def identify_cb(dev, res):
-            print('Identify finished')
-            try:
-                self._identify_match, self._identify_fp = self.dev.identify_finish(res)
-            except gi.repository.GLib.Error as e:
-                print(e)
-                self._identify_error = e
-
-        self._identify_fp = None
-        self.dev.identify([fp_whorl, fp_tented_arch], callback=identify_cb)
-        self.wait_for_finger_status(FPrint.FingerStatusFlags.NEEDED)
-        self.send_image('tented_arch')
-        while self._identify_fp is None:
-            ctx.iteration(True)
-        assert(self._identify_match is fp_tented_arch)
+        match, fp = self.run_match(self.dev.identify, self.dev.identify_finish,
+                                   templates, 'tented_arch')
+        assert(match is fp_tented_arch)
 
-        self._identify_fp = None
-        self.dev.identify([fp_whorl, fp_tented_arch], callback=identify_cb)
-        self.wait_for_finger_status(FPrint.FingerStatusFlags.NEEDED)
-        self.send_image('whorl')
-        while self._identify_fp is None:
-            ctx.iteration(True)
-        assert(self._identify_match is fp_whorl)
+        match, fp = self.run_match(self.dev.identify, self.dev.identify_finish,
+                                   templates, 'whorl')
+        assert(match is fp_whorl)
 
         # Test error cases
-        self._identify_fp = None
-        self._identify_error = None
-        self.dev.identify([fp_whorl, fp_tented_arch], callback=identify_cb)
-        self.wait_for_finger_status(FPrint.FingerStatusFlags.NEEDED)
-        self.send_retry()
-        while self._identify_fp is None and self._identify_error is None:
-            ctx.iteration(True)
-        assert(self._identify_error is not None)
-        assert(self._identify_error.matches(FPrint.device_retry_quark(), FPrint.DeviceRetry.TOO_SHORT))
-
-        self._identify_fp = None
-        self._identify_error = None
-        self.dev.identify([fp_whorl, fp_tented_arch], callback=identify_cb)
-        self.send_error()
-        while self._identify_fp is None and self._identify_error is None:
-            ctx.iteration(True)
-        assert(self._identify_error is not None)
-        assert(self._identify_error.matches(FPrint.device_error_quark(), FPrint.DeviceError.GENERAL))
+        error = self.run_match(self.dev.identify, self.dev.identify_finish,
+                               templates, self.send_retry)
+        self.assertIsInstance(error, GLib.Error)
+        assert(error.matches(FPrint.device_retry_quark(), FPrint.DeviceRetry.TOO_SHORT))
 
-    def test_verify_serialized(self):
-        done = False
-
-        def verify_cb(dev, res):
-            r, fp = dev.verify_finish(res)
-            self._verify_match = r
-            self._verify_fp = fp
+        error = self.run_match(self.dev.identify, self.dev.identify_finish,
+                               templates, self.send_error,
+                               wait_for_finger=False)
+        self.assertIsInstance(error, GLib.Error)
+        assert(error.matches(FPrint.device_error_quark(), FPrint.DeviceError.GENERAL))
 
+    def test_verify_serialized(self):
         fp_whorl = self.enroll_print('whorl')
 
         fp_data = fp_whorl.serialize()
@@ -409,32 +508,18 @@ class VirtualImage(unittest.TestCase):
         # The serialized/deserialized prints need to be equal
         assert fp_whorl.equal(fp_whorl_new)
 
-        datetime = GLib.DateTime.new_now_local()
-        date = GLib.Date()
-        date.set_dmy(*datetime.get_ymd()[::-1])
-
         assert fp_whorl_new.props.username == "testuser"
         assert fp_whorl_new.props.description == "test print"
         assert fp_whorl_new.props.finger == FPrint.Finger.LEFT_THUMB
-        assert date.compare(fp_whorl_new.props.enroll_date) == 0
+        assert today.compare(fp_whorl_new.props.enroll_date) == 0
 
-        self._verify_match = None
-        self._verify_fp = None
-        self.dev.verify(fp_whorl_new, callback=verify_cb)
-        self.wait_for_finger_status(FPrint.FingerStatusFlags.NEEDED)
-        self.send_image('whorl')
-        while self._verify_match is None:
-            ctx.iteration(True)
-        assert(self._verify_match)
-
-        self._verify_match = None
-        self._verify_fp = None
-        self.dev.verify(fp_whorl_new, callback=verify_cb)
-        self.wait_for_finger_status(FPrint.FingerStatusFlags.NEEDED)
-        self.send_image('tented_arch')
-        while self._verify_match is None:
-            ctx.iteration(True)
-        assert(not self._verify_match)
+        match, fp = self.run_match(self.dev.verify, self.dev.verify_finish,
+                                   fp_whorl_new, 'whorl')
+        assert(match)
+
+        match, fp = self.run_match(self.dev.verify, self.dev.verify_finish,
+                                   fp_whorl_new, 'tented_arch')
+        assert(not match)
 
 if __name__ == '__main__':
     try: